@@ -1,37 +1,61 @@
-import os
-import json
+import asyncio
 import base64
+import io
+import os
 import re
+import threading
+import uuid
+from collections import OrderedDict
+from itertools import chain
+import httpx
+import orjson
 import google.generativeai as genai
-from notion_client import Client
-from flask import Flask, request, jsonify, send_from_directory
-from flask_cors import CORS
+from PIL import Image, ImageOps, UnidentifiedImageError
+from pydantic import BaseModel, ValidationError, model_validator
+from notion_client import AsyncClient
+from quart import Quart, request, jsonify
+from quart.datastructures import FileStorage
+from quart.json.provider import DefaultJSONProvider
+from quart_cors import cors
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Routes jsonify and request JSON parsing through orjson
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
 
-app = Flask(__name__, static_folder='static')
-CORS(app)
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # orjson already produces bytes, so skip the str round-trip of the default provider
+        return self._app.response_class(orjson.dumps(self._prepare_response_obj(args, kwargs)), mimetype=self.mimetype)
+
+app = cors(Quart(__name__, static_folder='static'))
+app.json = OrjsonProvider(app)
+# Flask had no request size cap; Quart's 16MB default would reject a handful of full-size phone photos
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024
 
 genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
 
-RECIPE_PROMPT_JSON = """Return ONLY a valid JSON object with exactly these fields:
-{
-  "title": "recipe name",
-  "isImaginary": false,
-  "ingredients": {
-    "main": ["ingredient 1", "ingredient 2"],
-    "sauce": ["sauce ingredient 1"],
-    "spicesAndHerbs": ["spice 1", "herb 1"]
-  },
-  "steps": [
-    {
-      "instruction": "step instruction text",
-      "ingredients": ["ingredient A", "ingredient B"]
-    }
-  ],
-  "cookTime": "time or null",
-  "servings": "servings or null",
-  "lang": "en",
-  "categories": ["Meal"]
-}
+# Shared across requests so the SDK reuses its transport instead of rebuilding it per call
+MODEL = genai.GenerativeModel('gemini-2.5-flash-lite')
+_notion = None
+
+# Longest side, in pixels, of images sent to Gemini; phone screenshots are often 3000-4000px
+MAX_IMAGE_EDGE = 1536
+# Pillow formats Gemini accepts as they are; anything else is re-encoded to JPEG
+GEMINI_IMAGE_FORMATS = {'JPEG', 'PNG', 'WEBP'}
+_upload_lock = threading.Lock()
+
+# Background Notion saves by job id, oldest first; only the most recent are kept for polling
+NOTION_JOBS_KEPT = 256
+_notion_jobs = OrderedDict()
+
+# Internal Nginx location (e.g. "/internal-static/") that serves the static folder; unset means serve from Python
+STATIC_ACCEL_REDIRECT = os.environ.get("STATIC_ACCEL_REDIRECT")
+
+RECIPE_INSTRUCTIONS = """Fill in the recipe fields of the response schema: title, ingredients, steps (each with the ingredients it uses), cookTime and servings (null if not given), lang, categories and hasWrittenRecipe.
 Set "lang" to "fr" if the recipe is in French, "ko" if Korean, "en" for everything else.
 For "categories", pick ALL that apply from this list: "Breakfast", "Meal", "Salad", "Dessert", "Bread", "Drinks". A recipe can have multiple categories.
 
@@ -45,206 +69,396 @@ LANGUAGE RULES:
 - If the recipe is in any other language, translate everything to English.
 - The section headers (like ingredients, steps) should also match the recipe language. For French use: "Ingrédients principaux", h_sauce, "Épices & Herbes", "Étapes". For Korean use: "주재료", "소스", "양념 & 허브", "조리 방법".
 
-Set "isImaginary" to true if the image contains NO written recipe text and you are creating the recipe yourself based on what the food looks like. Set to false ONLY if there is actual written recipe text visible in the image.
+Set "hasWrittenRecipe" to true ONLY if the image contains actual written recipe text — meaning a real ingredients list with quantities AND/OR numbered cooking steps. Captions, hashtags, usernames, titles, or short descriptions do NOT count. Set it to false if you are creating the recipe yourself based on what the food looks like.
 Categorize ingredients: main = proteins, vegetables, grains, dairy. sauce = liquids, oils, vinegars, condiments. spicesAndHerbs = dried/fresh spices, herbs, seasonings, salt, pepper.
-For each step, list only the ingredients actually used in that step. If none, return empty array.
-No markdown, no extra text, just the JSON."""
+For each step, list only the ingredients actually used in that step. If none, return empty array."""
 
-@app.route('/')
-def index():
-    return send_from_directory('static', 'index.html')
+_STRING_LIST = {"type": "array", "items": {"type": "string"}}
 
-@app.route('/extract', methods=['POST'])
-def extract_recipe():
-    try:
-        model = genai.GenerativeModel('gemini-2.5-flash-lite')
-        recipe = None
-        source = "image"
+# Shape of the JSON Gemini returns; structured output mode guarantees the response
+# parses against it, so the prompt only has to describe what goes in each field
+RECIPE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "hasWrittenRecipe": {"type": "boolean"},
+        "ingredients": {
+            "type": "object",
+            "properties": {"main": _STRING_LIST, "sauce": _STRING_LIST, "spicesAndHerbs": _STRING_LIST},
+            "required": ["main", "sauce", "spicesAndHerbs"],
+        },
+        "steps": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"instruction": {"type": "string"}, "ingredients": _STRING_LIST},
+                "required": ["instruction", "ingredients"],
+            },
+        },
+        "cookTime": {"type": "string", "nullable": True},
+        "servings": {"type": "string", "nullable": True},
+        "lang": {"type": "string", "format": "enum", "enum": ["en", "fr", "ko"]},
+        "categories": {
+            "type": "array",
+            "items": {"type": "string", "format": "enum", "enum": ["Breakfast", "Meal", "Salad", "Dessert", "Bread", "Drinks"]},
+        },
+    },
+    "required": ["title", "hasWrittenRecipe", "ingredients", "steps", "cookTime", "servings", "lang", "categories"],
+}
 
-        # --- TEXT MODE ---
-        recipe_text = request.form.get('recipe_text', '').strip()
-        if recipe_text:
-            prompt = f"Extract and structure a recipe from this text.\n\nText:\n{recipe_text}\n\n{RECIPE_PROMPT_JSON}"
-            response = model.generate_content(prompt)
-            text = response.text.strip().replace('```json', '').replace('```', '').strip()
-            recipe = json.loads(text)
-            recipe['isImaginary'] = False
-            source = "text"
+# Parsed form of a Gemini extraction; model_validate_json parses and checks the shape in one pass
+class Ingredients(BaseModel):
+    main: list[str] = []
+    sauce: list[str] = []
+    spicesAndHerbs: list[str] = []
 
-        # --- IMAGE MODE ---
-        else:
-            if 'images' not in request.files:
-                return jsonify({'error': 'Please provide recipe text or upload images.'}), 400
-            files = request.files.getlist('images')
-            if not files:
-                return jsonify({'error': 'No images provided'}), 400
-            image_parts = []
-            for file in files:
-                image_data = file.read()
-                image_parts.append({"mime_type": file.content_type, "data": base64.b64encode(image_data).decode('utf-8')})
-            prompt = f"""Look at these images carefully.
+class Step(BaseModel):
+    instruction: str
+    ingredients: list[str] = []
+
+class Recipe(BaseModel):
+    title: str
+    hasWrittenRecipe: bool = True
+    # Set by the server from hasWrittenRecipe, not requested from Gemini
+    isImaginary: bool = False
+    ingredients: Ingredients
+    steps: list[Step]
+    cookTime: str | None = None
+    servings: str | None = None
+    lang: str = "en"
+    categories: list[str] = []
+
+    @model_validator(mode='after')
+    def check_not_empty(self):
+        # A well-formed but empty extraction would still cost a Notion write for a useless page
+        if not self.title.strip():
+            raise ValueError("recipe has no title")
+        ingredients = self.ingredients
+        if not (ingredients.main or ingredients.sauce or ingredients.spicesAndHerbs or self.steps):
+            raise ValueError("recipe has no ingredients or steps")
+        return self
+
+# Passed per call rather than baked into MODEL
+RECIPE_GENERATION_CONFIG = {"response_mime_type": "application/json", "response_schema": RECIPE_SCHEMA}
+
+# App instructions, including the mode-specific ones, all sit above the marker;
+# only the user's text or images follow it. Built once at import
+USER_INPUT_MARKER = "\n\n---USER INPUT FOLLOWS---\n"
+TEXT_PROMPT_PREFIX = RECIPE_INSTRUCTIONS + "\n\nExtract and structure a recipe from the text below." + USER_INPUT_MARKER
+IMAGE_PROMPT = RECIPE_INSTRUCTIONS + """
+
+Look at these images carefully.
 CASE 1: If the image contains an actual written recipe, extract it exactly.
 - If multiple images are provided and overlap in content, treat them as one continuous recipe — do NOT duplicate or average out quantities.
 - Always use the FIRST complete mention of each ingredient's quantity. Do not guess or adjust amounts.
 - Include ALL ingredients mentioned including toppings, garnishes, and serving suggestions.
-CASE 2: If the image only shows a food photo without a written recipe, create a realistic recipe for what you see.
-{RECIPE_PROMPT_JSON}"""
-            parts = [prompt] + [{"inline_data": img} for img in image_parts]
-            response = model.generate_content(parts)
-            text = response.text.strip().replace('```json', '').replace('```', '').strip()
-            recipe = json.loads(text)
-            source = "image"
+CASE 2: If the image only shows a food photo without a written recipe, create a realistic recipe for what you see.""" + USER_INPUT_MARKER
 
-            # Double-check if recipe is imaginary with a separate simple question
-            check_parts = ["Does this image contain actual written recipe text — meaning a real ingredients list with quantities AND/OR numbered cooking steps? Captions, hashtags, usernames, titles, or short descriptions do NOT count. Answer only YES or NO."] + [{"inline_data": img} for img in image_parts]
-            check_response = model.generate_content(check_parts)
-            has_text = "YES" in check_response.text.upper()
-            if not has_text:
-                recipe['isImaginary'] = True
+# Section headers always in English
+H_INGREDIENTS = "🥘 Ingredients"
+H_MAIN = "Main Ingredients"
+H_SAUCE = "Sauce"
+H_SPICES = "Spices & Herbs"
+H_STEPS = "👨‍🍳 Steps"
+H_HISTORY = "📸 Seora's History"
+HISTORY_NOTE = "Drop your photos here when you make this recipe! 🍽️"
 
-        # --- SAVE TO NOTION ---
+# Notion accepts at most 100 child blocks per create/append request
+NOTION_MAX_CHILDREN = 100
+# Notion allows an average of 3 requests per second per integration
+NOTION_REQUEST_INTERVAL = 0.34
+_notion_lock = asyncio.Lock()
+_notion_last_request = float('-inf')
+
+# Trailing gram conversion such as "(120g)", compiled once at import
+_GRAM_RE = re.compile(r'(.*?)(\s*\(\s*[\d.]+\s*g\s*\))\s*$')
+
+# Constant outer keys of each block type, built once; factories only build the inner dict that varies
+_BLOCK_SKELETONS = {t: {"object": "block", "type": t} for t in ("to_do", "heading_2", "heading_3", "paragraph", "callout", "divider")}
+
+def rt(content, link=None, **annotations):
+    # One Notion rich-text run; annotations are only included when given
+    text = {"content": content}
+    if link:
+        text["link"] = {"url": link}
+    run = {"type": "text", "text": text}
+    if annotations:
+        run["annotations"] = annotations
+    return run
+
+def parse_ingredient_rich_text(text):
+    # Split "1 cup flour (120g)" into original measure and grey conversion
+    # Only text ending in ")" can carry a "(Xg)" conversion, so skip the regex for everything else
+    match = _GRAM_RE.match(text) if text.rstrip().endswith(')') else None
+    if match:
+        main = match.group(1).strip()
+        converted = "    " + match.group(2).strip()
+        return [rt(main), rt(converted, color="gray")]
+    return [rt(text)]
+
+def block(block_type, body):
+    return {**_BLOCK_SKELETONS[block_type], block_type: body}
+
+def checkbox(text, rich=False):
+    rich_text = parse_ingredient_rich_text(text) if rich else [rt(text)]
+    return block("to_do", {"rich_text": rich_text, "checked": False})
+
+def heading2(*rich_text):
+    return block("heading_2", {"rich_text": list(rich_text)})
+
+def heading3(text):
+    return block("heading_3", {"rich_text": [rt(text)]})
+
+def paragraph(*rich_text):
+    return block("paragraph", {"rich_text": list(rich_text)})
+
+def callout(text, emoji, color):
+    return block("callout", {"rich_text": [rt(text)], "icon": {"emoji": emoji}, "color": color})
+
+def divider():
+    return block("divider", {})
+
+def iter_steps(steps):
+    for step in steps:
+        yield checkbox(step.instruction)
+        if step.ingredients:
+            yield paragraph(rt("🧂 " + "  ·  ".join(step.ingredients), color="blue", italic=True))
+
+def iter_ingredients(heading, items):
+    if items:
+        yield heading3(heading)
+        for i in items:
+            yield checkbox(i, rich=True)
+
+def iter_children(recipe, source_link):
+    # Yields the Notion page blocks top to bottom
+    if recipe.isImaginary:
+        yield callout("⚠️ This is an AI-imagined recipe based on a food photo. Use as inspiration only!", "🤖", "yellow_background")
+
+    yield callout(f"⏱ Cook Time: {recipe.cookTime or 'N/A'}     ⭐ My Rating:  ☆ ☆ ☆ ☆ ☆", "🍳", "orange_background")
+    yield divider()
+    yield heading2(rt(H_INGREDIENTS))
+    yield from iter_ingredients(H_MAIN, recipe.ingredients.main)
+    yield from iter_ingredients(H_SAUCE, recipe.ingredients.sauce)
+    yield from iter_ingredients(H_SPICES, recipe.ingredients.spicesAndHerbs)
+
+    yield divider()
+    yield heading2(rt(H_STEPS))
+    yield from iter_steps(recipe.steps)
+
+    # Add Seora's History section
+    yield divider()
+    yield heading2(rt(H_HISTORY, color="pink"))
+    yield paragraph(rt(HISTORY_NOTE, color="gray", italic=True))
+
+    # Add source link at bottom if provided
+    if source_link:
+        yield divider()
+        yield paragraph(rt("🔗 Source: ", bold=True), rt(source_link, link=source_link, color="blue"))
+
+async def wait_for_notion_slot():
+    # The rate limit is per integration, so every Notion call from every save shares one schedule:
+    # each call starts at least NOTION_REQUEST_INTERVAL after the previous call started
+    global _notion_last_request
+    async with _notion_lock:
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(0, _notion_last_request + NOTION_REQUEST_INTERVAL - loop.time()))
+        _notion_last_request = loop.time()
+
+def get_notion(notion_token):
+    # Created on first use, so the app still starts (and serves the page) without Notion configured
+    global _notion
+    if _notion is None:
+        # HTTP/2 lets the page create and any follow-up appends share one kept-alive connection;
+        # idle connections are kept for a minute so submissions a few seconds apart skip the TLS handshake
+        limits = httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=60)
+        http_client = httpx.AsyncClient(http2=True, limits=limits)
+        _notion = AsyncClient(auth=notion_token, client=http_client)
+    return _notion
+
+def upload_to_gemini(stream, mime_type):
+    # genai.upload_file sends every upload through one shared httplib2 connection, which is not
+    # thread-safe, so only the Pillow work runs in parallel and the uploads take turns
+    with _upload_lock:
+        return genai.upload_file(stream, mime_type=mime_type)
+
+def upload_image(file):
+    # Downscale to a JPEG before uploading: Gemini bills per image tile and shrinks large images anyway
+    try:
+        img = Image.open(file.stream)
+    except UnidentifiedImageError:
+        # Formats Pillow can't decode (e.g. HEIC) are still understood by Gemini, so send them as-is
+        file.stream.seek(0)
+        return upload_to_gemini(file.stream, mime_type=file.content_type)
+    if max(img.size) <= MAX_IMAGE_EDGE and img.format in GEMINI_IMAGE_FORMATS:
+        # Already small enough: send the original bytes so lossless screenshots and
+        # browser-shrunk JPEGs are not compressed a second time
+        file.stream.seek(0)
+        return upload_to_gemini(file.stream, mime_type=Image.MIME[img.format])
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.convert('RGB').save(buf, 'JPEG', quality=85)
+    buf.seek(0)
+    return upload_to_gemini(buf, mime_type='image/jpeg')
+
+async def save_to_notion(recipe, source_link, notion_token, notion_database_id):
+    is_imaginary = recipe.isImaginary
+    # notion-client needs a list, but it is materialized once from the generator with no intermediate lists
+    children = list(iter_children(recipe, source_link))
+
+    title = recipe.title
+    if is_imaginary:
+        title = f"✨ {title} (AI Recipe)"
+
+    notion = get_notion(notion_token)
+    await wait_for_notion_slot()
+    notion_response = await notion.pages.create(
+        parent={"database_id": notion_database_id},
+        icon={"emoji": "🤖" if is_imaginary else "🍽️"},
+        properties={
+            "title": {"title": [{"text": {"content": title}}]},
+            "Category": {"multi_select": [{"name": c} for c in recipe.categories]}
+        },
+        children=children[:NOTION_MAX_CHILDREN]
+    )
+    # Append the rest of long recipes in order (concurrent appends could interleave them)
+    for start in range(NOTION_MAX_CHILDREN, len(children), NOTION_MAX_CHILDREN):
+        await wait_for_notion_slot()
+        await notion.blocks.children.append(block_id=notion_response["id"], children=children[start:start + NOTION_MAX_CHILDREN])
+
+    print("DEBUG categories:", recipe.categories, flush=True)
+    print("DEBUG notion response:", notion_response.get("url"), flush=True)
+    return notion_response.get('url', '')
+
+async def run_notion_job(job_id, *args):
+    try:
+        result = {'status': 'done', 'notion_url': await save_to_notion(*args)}
+    except Exception as e:
+        result = {'status': 'error', 'error': str(e)}
+    # A job evicted while it was still pending stays evicted, so the dict never grows past NOTION_JOBS_KEPT
+    if job_id in _notion_jobs:
+        _notion_jobs[job_id] = result
+
+async def read_submission():
+    # API clients may POST JSON instead of multipart to skip the form parser:
+    # {"recipe_text": ..., "source_link": ..., "images": [{"mime_type": ..., "data": <base64>}]}
+    if request.is_json:
+        body = await request.get_json(silent=True)
+        # Malformed JSON comes back as None; anything other than an object of string fields is rejected too
+        if not isinstance(body, dict):
+            raise ValueError("JSON body must be an object")
+        if not all(isinstance(body.get(key), (str, type(None))) for key in ('recipe_text', 'source_link')):
+            raise TypeError("recipe_text and source_link must be strings")
+        files = [
+            FileStorage(io.BytesIO(base64.b64decode(img["data"], validate=True)), content_type=img.get("mime_type", "image/jpeg"))
+            for img in body.get("images") or []
+        ]
+        return body, files
+    return await request.form, (await request.files).getlist('images')
+
+def delete_uploaded_files(uploaded_files):
+    for uploaded in uploaded_files:
+        genai.delete_file(uploaded.name)
+
+@app.after_serving
+async def close_notion():
+    # Close the shared client's kept-alive HTTP/2 connections when Hypercorn shuts down
+    if _notion is not None:
+        await _notion.aclose()
+
+@app.route('/')
+async def index():
+    # Behind Nginx, hand the page off so it is sent with sendfile() instead of read through Python
+    if STATIC_ACCEL_REDIRECT:
+        return "", 200, {"X-Accel-Redirect": STATIC_ACCEL_REDIRECT + "index.html"}
+    return await app.send_static_file('index.html')
+
+@app.route('/extract', methods=['POST'])
+async def extract_recipe():
+    try:
+        # Fail before spending a Gemini call if the recipe could not be saved anyway
         notion_token = os.environ.get("NOTION_TOKEN")
         notion_database_id = os.environ.get("NOTION_DATABASE_ID")
         if not notion_token or not notion_database_id:
             return jsonify({'error': 'Notion not configured'}), 500
 
-        notion = Client(auth=notion_token)
-        is_imaginary = recipe.get("isImaginary", False)
-        ingredients = recipe.get("ingredients", {})
-        steps = recipe.get("steps", [])
-        # Section headers always in English
-        h_ingredients = "🥘 Ingredients"
-        h_main = "Main Ingredients"
-        h_sauce = "Sauce"
-        h_spices = "Spices & Herbs"
-        h_steps = "👨‍🍳 Steps"
-        h_history = "📸 Seora's History"
-        history_note = "Drop your photos here when you make this recipe! 🍽️"
-
-        if isinstance(ingredients, list):
-            main_list, sauce_list, spice_list = ingredients, [], []
-        else:
-            main_list = ingredients.get("main", [])
-            sauce_list = ingredients.get("sauce", [])
-            spice_list = ingredients.get("spicesAndHerbs", [])
-
-        def parse_ingredient_rich_text(text):
-            # Split "1 cup flour (120g)" into original measure and grey conversion
-            match = re.search(r'^(.*?)(\s*\(\s*[\d.]+\s*g\s*\))\s*$', text)
-            if match:
-                main = match.group(1).strip()
-                converted = "    " + match.group(2).strip()
-                return [
-                    {"type": "text", "text": {"content": main}},
-                    {"type": "text", "text": {"content": converted}, "annotations": {"color": "gray"}}
-                ]
-            return [{"type": "text", "text": {"content": text}}]
-
-        def checkbox(text, rich=False):
-            rich_text = parse_ingredient_rich_text(text) if rich else [{"type": "text", "text": {"content": text}}]
-            return {"object": "block", "type": "to_do", "to_do": {"rich_text": rich_text, "checked": False}}
-
-        def heading3(text):
-            return {"object": "block", "type": "heading_3", "heading_3": {"rich_text": [{"type": "text", "text": {"content": text}}]}}
-
-        def build_steps(steps):
-            blocks = []
-            for step in steps:
-                instruction = step if isinstance(step, str) else step.get("instruction", "")
-                step_ings = [] if isinstance(step, str) else step.get("ingredients", [])
-                blocks.append(checkbox(instruction))
-                if step_ings:
-                    blocks.append({"object": "block", "type": "paragraph", "paragraph": {"rich_text": [{"type": "text", "text": {"content": "🧂 " + "  ·  ".join(step_ings)}, "annotations": {"color": "blue", "italic": True}}]}})
-            return blocks
-
-        children = []
-        if is_imaginary:
-            children.append({"object": "block", "type": "callout", "callout": {"rich_text": [{"type": "text", "text": {"content": "⚠️ This is an AI-imagined recipe based on a food photo. Use as inspiration only!"}}], "icon": {"emoji": "🤖"}, "color": "yellow_background"}})
-
-
-        children += [
-            {"object": "block", "type": "callout", "callout": {"rich_text": [{"type": "text", "text": {"content": f"⏱ Cook Time: {recipe.get('cookTime') or 'N/A'}     ⭐ My Rating:  ☆ ☆ ☆ ☆ ☆"}}], "icon": {"emoji": "🍳"}, "color": "orange_background"}},
-
-            {"object": "block", "type": "divider", "divider": {}},
-            {"object": "block", "type": "heading_2", "heading_2": {"rich_text": [{"type": "text", "text": {"content": h_ingredients}}]}},
-        ]
-        if main_list:
-            children.append(heading3(h_main))
-            children.extend([checkbox(i, rich=True) for i in main_list])
-        if sauce_list:
-            children.append(heading3(h_sauce))
-            children.extend([checkbox(i, rich=True) for i in sauce_list])
-        if spice_list:
-            children.append(heading3(h_spices))
-            children.extend([checkbox(i, rich=True) for i in spice_list])
-        children += [
-            {"object": "block", "type": "divider", "divider": {}},
-            {"object": "block", "type": "heading_2", "heading_2": {"rich_text": [{"type": "text", "text": {"content": h_steps}}]}},
-            *build_steps(steps),
-        ]
+        source = "image"
+        try:
+            form, files = await read_submission()
+        except RequestEntityTooLarge:
+            max_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+            return jsonify({'error': f'Upload too large (max {max_mb}MB). Try fewer or smaller images.'}), 413
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return jsonify({'error': 'Invalid request body.'}), 400
 
-        # Add Seora's History section
-        children += [
-            {"object": "block", "type": "divider", "divider": {}},
-            {
-                "object": "block",
-                "type": "heading_2",
-                "heading_2": {
-                    "rich_text": [{"type": "text", "text": {"content": h_history}, "annotations": {"color": "pink"}}]
-                }
-            },
-            {
-                "object": "block",
-                "type": "paragraph",
-                "paragraph": {
-                    "rich_text": [{"type": "text", "text": {"content": history_note}, "annotations": {"color": "gray", "italic": True}}]
-                }
-            },
-        ]
+        # --- TEXT MODE ---
+        recipe_text = (form.get('recipe_text') or '').strip()
+        if recipe_text:
+            response = await MODEL.generate_content_async(TEXT_PROMPT_PREFIX + recipe_text, generation_config=RECIPE_GENERATION_CONFIG)
+            recipe = Recipe.model_validate_json(response.text)
+            source = "text"
 
-        # Add source link at bottom if provided
-        source_link = request.form.get('source_link', '').strip()
-        if source_link:
-            children.append({"object": "block", "type": "divider", "divider": {}})
-            children.append({
-                "object": "block",
-                "type": "paragraph",
-                "paragraph": {
-                    "rich_text": [
-                        {"type": "text", "text": {"content": "🔗 Source: "}, "annotations": {"bold": True}},
-                        {"type": "text", "text": {"content": source_link, "link": {"url": source_link}}, "annotations": {"color": "blue"}}
-                    ]
-                }
-            })
-
-
-
-        title = recipe.get("title", "Untitled Recipe")
-        if is_imaginary:
-            title = f"✨ {title} (AI Recipe)"
-
-        notion_response = notion.pages.create(
-            parent={"database_id": notion_database_id},
-            icon={"emoji": "🤖" if is_imaginary else "🍽️"},
-            properties={
-                "title": {"title": [{"text": {"content": title}}]},
-                "Category": {"multi_select": [{"name": c} for c in recipe.get("categories", [])]}
-            },
-            children=children
-        )
+        # --- IMAGE MODE ---
+        else:
+            if not files:
+                return jsonify({'error': 'Please provide recipe text or upload images.'}), 400
+            # Upload each (downscaled) image to the Gemini Files API rather than inlining its bytes
+            uploaded_files = []
+            try:
+                # Pillow releases the GIL, so preprocess the images in parallel threads
+                results = await asyncio.gather(*(asyncio.to_thread(upload_image, file) for file in files), return_exceptions=True)
+                # Keep the uploads that succeeded so they are still deleted if another image failed
+                uploaded_files = [r for r in results if not isinstance(r, BaseException)]
+                for r in results:
+                    if isinstance(r, BaseException):
+                        raise r
+                parts = [IMAGE_PROMPT] + uploaded_files
+                response = await MODEL.generate_content_async(parts, generation_config=RECIPE_GENERATION_CONFIG)
+            finally:
+                app.add_background_task(delete_uploaded_files, uploaded_files)
+            recipe = Recipe.model_validate_json(response.text)
+            source = "image"
+            # The written-recipe check is answered in the same call as the extraction
+            recipe.isImaginary = not recipe.hasWrittenRecipe
+
+        # --- SAVE TO NOTION ---
+        # Saved in the background so the browser gets the recipe as soon as Gemini is done;
+        # it polls /notion_status/<job_id> for the page URL
+        source_link = (form.get('source_link') or '').strip()
+        job_id = uuid.uuid4().hex
+        _notion_jobs[job_id] = {'status': 'pending'}
+        if len(_notion_jobs) > NOTION_JOBS_KEPT:
+            _notion_jobs.popitem(last=False)
+        app.add_background_task(run_notion_job, job_id, recipe, source_link, notion_token, notion_database_id)
 
-        all_ingredients = main_list + sauce_list + spice_list
-        flat_steps = [s if isinstance(s, str) else s.get("instruction", "") for s in steps]
-        print("DEBUG categories:", recipe.get("categories", []), flush=True)
-        print("DEBUG notion response:", notion_response.get("url"), flush=True)
-        notion_url = notion_response.get('url', '')
-        return jsonify({'success': True, 'isImaginary': is_imaginary, 'source': source, 'notion_url': notion_url, 'recipe': {**recipe, 'ingredients': all_ingredients, 'steps': flat_steps}})
+        # The recipe keeps its structured ingredients/steps; the flat lists are what the page renders
+        ingredients = recipe.ingredients
+        return jsonify({
+            'success': True, 'isImaginary': recipe.isImaginary, 'source': source, 'notion_job_id': job_id,
+            # hasWrittenRecipe only means something for images and is already reflected in isImaginary
+            'recipe': recipe.model_dump(exclude={'hasWrittenRecipe'}),
+            'ingredients_flat': list(chain(ingredients.main, ingredients.sauce, ingredients.spicesAndHerbs)),
+            'steps_flat': [s.instruction for s in recipe.steps],
+        })
 
-    except json.JSONDecodeError:
+    except ValidationError:
         return jsonify({'error': 'Could not parse recipe. Try again or rephrase the text.'}), 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/notion_status/<job_id>')
+async def notion_status(job_id):
+    job = _notion_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
 if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
+    # Serve with Hypercorn, the same ASGI server used in deployment, rather than Quart's dev server
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"0.0.0.0:{int(os.environ.get('PORT', 5000))}"]
+    asyncio.run(serve(app, config))